@@ -1,14 +1,25 @@
 import os
 import time
 import base64
+import asyncio
+import functools
 import hashlib
-from typing import Optional, Dict, Tuple
+import mmap
+import sqlite3
+import threading
+import zlib
+from typing import Optional, Dict, List, Literal, Tuple
 
 from dotenv import load_dotenv
 import httpx
+import orjson
+import redis.asyncio as aioredis
+from cachetools import TLRUCache
+from redis.exceptions import RedisError
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, field_validator
 
 # --------------------------------------------------
 # Load environment variables from .env
@@ -21,28 +32,128 @@ load_dotenv()
 ALLOWED_ORIGIN = os.getenv("ALLOWED_ORIGIN", "*")
 
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "")
-REPLICATE_MODEL = os.getenv("REPLICATE_MODEL", "black-forest-labs/flux-schnell")
 REPLICATE_FAST_MODEL = os.getenv("REPLICATE_FAST_MODEL", "black-forest-labs/flux-schnell")
 REPLICATE_QUALITY_MODEL = os.getenv("REPLICATE_QUALITY_MODEL", "black-forest-labs/flux-dev")
+REPLICATE_MODE = os.getenv("REPLICATE_MODE", "fast").strip().lower()  # default when a request sends no mode
+if REPLICATE_MODE not in ("fast", "quality"):
+    raise RuntimeError("REPLICATE_MODE must be 'fast' or 'quality'")
+REPLICATE_TIMEOUT_SECONDS = float(os.getenv("REPLICATE_TIMEOUT_SECONDS", "180"))
+# Seconds Replicate may hold the create call open until the prediction finishes (max 60, 0 = off)
+REPLICATE_PREFER_WAIT = int(os.getenv("REPLICATE_PREFER_WAIT", "60"))
+# Max concurrent Replicate jobs per worker, and retries of a rate-limited/5xx create
+REPLICATE_CONCURRENCY = int(os.getenv("REPLICATE_CONCURRENCY", "8"))
+REPLICATE_MAX_RETRIES = int(os.getenv("REPLICATE_MAX_RETRIES", "3"))
+# How long a request may wait for one of those slots before getting a 503
+REPLICATE_QUEUE_SECONDS = float(os.getenv("REPLICATE_QUEUE_SECONDS", "20"))
+
+# Public base URL of this API. When set, Replicate calls back on completion
+# and polling drops to a slow fallback cadence.
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").strip().rstrip("/")
+WEBHOOK_FALLBACK_SECONDS = float(os.getenv("WEBHOOK_FALLBACK_SECONDS", "10"))
 
 def resolve_model(mode: str) -> str:
     return REPLICATE_FAST_MODEL if mode == "fast" else REPLICATE_QUALITY_MODEL
 
 CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "86400"))
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "1024"))
+# Optional: keep cached images on disk here, holding only paths in memory
+CACHE_DIR = os.getenv("CACHE_DIR", "").strip()
+# Optional: SQLite file that keeps cached images across restarts
+CACHE_DB = os.getenv("CACHE_DB", "").strip()
 RATE_LIMIT_SECONDS = float(os.getenv("RATE_LIMIT_SECONDS", "2.5"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "3"))
+RATE_LIMIT_MAX_IPS = int(os.getenv("RATE_LIMIT_MAX_IPS", "100000"))
+SWEEP_INTERVAL_SECONDS = float(os.getenv("SWEEP_INTERVAL_SECONDS", "60"))
 
 DME_IMAGE_RES = os.getenv("DME_IMAGE_RES", "2K").strip().upper()  # "2K" default (unchanged)
 
+# Optional: share the image cache and rate limits across workers/replicas.
+# Unset keeps all state in-process.
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+# Keep these short: a hung Redis must fall back to local state, not stall
+# every request until the OS gives up on the socket
+REDIS_TIMEOUT_SECONDS = float(os.getenv("REDIS_TIMEOUT_SECONDS", "0.5"))
+REDIS_CONNECT_TIMEOUT_SECONDS = float(os.getenv("REDIS_CONNECT_TIMEOUT_SECONDS", "0.5"))
+
 # --------------------------------------------------
 # In-memory cache + throttle
 # --------------------------------------------------
-_cache: Dict[str, Tuple[float, dict]] = {}
-_last_call_by_ip: Dict[str, float] = {}
+CacheKey = Tuple[str, ...]
+
+def _entry_expiry(_key, value, _now) -> float:
+    # Each entry carries its own deadline, so an image promoted from SQLite or
+    # Redis only lives as long as it had left there
+    return value[2]
+
+class _FileTLRUCache(TLRUCache):
+    """TLRUCache of (mime, path, expires) values that deletes a file when its entry
+    is evicted or replaced. Every write gets its own path, so evicting a stale entry can
+    never remove the file of the entry replacing it."""
+
+    def __setitem__(self, key, value):
+        old = super().get(key)
+        super().__setitem__(key, value)
+        if old is not None and old[1] != value[1]:
+            _remove_file(old[1])
+
+    def popitem(self):
+        key, value = super().popitem()
+        _remove_file(value[1])
+        return key, value
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, (_, path, _) in expired:
+            _remove_file(path)
+        return expired
+
+def _remove_file(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # Runs inside cache eviction; a stuck file must not fail the write
+        print(f"[cache] could not remove {path}: {e}")
+
+def _sweep_cache_dir():
+    # The index lives in memory, so files from a previous run (or a crashed
+    # write) are orphaned; anything older than the TTL is dead either way
+    cutoff = time.time() - CACHE_TTL_SECONDS
+    try:
+        with os.scandir(CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+    except OSError as e:
+        print(f"[cache] CACHE_DIR sweep failed: {e}")
+
+# Bounded: least-recently-used entries are evicted once CACHE_MAXSIZE is hit.
+# Values are (mime, zlib blob, monotonic expiry), with a blob path in place of
+# the blob when CACHE_DIR is set.
+if CACHE_DIR:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    _cache: TLRUCache = _FileTLRUCache(maxsize=CACHE_MAXSIZE, ttu=_entry_expiry, timer=time.monotonic)
+else:
+    _cache = TLRUCache(maxsize=CACHE_MAXSIZE, ttu=_entry_expiry, timer=time.monotonic)
+# Token bucket per IP: [tokens, last_refill_ts], refilled at 1 / RATE_LIMIT_SECONDS
+_last_call_by_ip: Dict[str, List[float]] = {}
+# Single-flight: cache key -> result of the generation currently running for it
+_inflight: Dict[CacheKey, asyncio.Future] = {}
+# Replicate prediction id -> event set by the completion webhook
+_pending: Dict[str, asyncio.Event] = {}
+# SQLite L2 cache, opened at startup when CACHE_DB is set. Queries run in
+# worker threads, so they share the connection under a lock.
+_db: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
 
 # --------------------------------------------------
 # App
 # --------------------------------------------------
-app = FastAPI(title="Design My Event API")
+app = FastAPI(title="Design My Event API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -52,66 +163,381 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# No GZipMiddleware: /api/generate is the only response big enough to gain
+# from it, and gzipping its base64 image saves ~24% for ~150 ms of CPU per
+# 4 MB at any level. That work runs on the event loop and stalls every
+# in-flight poll, so compress at a reverse proxy if the bandwidth matters.
+
+@app.on_event("startup")
+async def _open_http_client():
+    # One pooled client for the app lifetime: Replicate polls and image
+    # downloads reuse TCP/TLS connections instead of reconnecting per call.
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=120.0,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    )
+
+@app.on_event("shutdown")
+async def _close_http_client():
+    await app.state.http.aclose()
+
+@app.on_event("startup")
+async def _open_redis():
+    app.state.redis = (
+        aioredis.Redis.from_url(
+            REDIS_URL,
+            socket_timeout=REDIS_TIMEOUT_SECONDS,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS,
+        )
+        if REDIS_URL
+        else None
+    )
+    if app.state.redis is not None:
+        app.state.take_token = app.state.redis.register_script(_TOKEN_BUCKET_LUA)
+
+@app.on_event("shutdown")
+async def _close_redis():
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+@app.on_event("startup")
+async def _open_cache_db():
+    global _db
+    if not CACHE_DB:
+        return
+
+    # Autocommit + WAL: each write is its own short transaction and readers
+    # (including other workers on the same file) never block on it
+    _db = sqlite3.connect(CACHE_DB, isolation_level=None, check_same_thread=False)
+    _db.execute("PRAGMA journal_mode=WAL")
+    _db.execute("PRAGMA synchronous=NORMAL")
+    _db.execute(
+        "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, ts REAL, mime TEXT, data BLOB)"
+    )
+    await asyncio.to_thread(_db_expire)
+
+@app.on_event("shutdown")
+async def _close_cache_db():
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
+
 # --------------------------------------------------
 # Models
 # --------------------------------------------------
+# Must match the keys of _MOOD_MAP / _LAYOUT_MAP below
+Mood = Literal["Editorial", "Luxe", "Minimal", "Mediterranean", "Manhattan"]
+Layout = Literal["Cocktail", "Long Tables", "Banquet", "Theatre"]
+# Anything else would silently fall through to the (expensive) quality model
+Mode = Literal["fast", "quality"]
+
 class GenerateRequest(BaseModel):
-    mood: str = Field(..., min_length=2, max_length=40)
-    layout: str = Field(..., min_length=2, max_length=40)
+    mood: Mood
+    layout: Layout
     room: Optional[str] = Field(None, max_length=80)
     venue_image_url: Optional[str] = None
     av_equipment: Optional[str] = Field(None, max_length=10)
     uplighting_colour: Optional[str] = Field(None, max_length=20)
+    mode: Optional[Mode] = None
+    return_url_only: bool = Field(
+        False,
+        description=(
+            "Return Replicate's (expiring) image URL in image_url instead of a data URL. "
+            "Only fresh generations have one: cache hits still return image_data_url, "
+            "so clients must handle both fields."
+        ),
+    )
 
+    # Normalised once here so the handlers compare plain strings
+    @field_validator("av_equipment")
+    @classmethod
+    def _upper(cls, v: Optional[str]) -> Optional[str]:
+        return v.strip().upper() if v is not None else None
+
+    @field_validator("uplighting_colour")
+    @classmethod
+    def _lower(cls, v: Optional[str]) -> Optional[str]:
+        return v.strip().lower() if v is not None else None
+
+    # Runs before the Literal check, so " Quality" is still accepted
+    @field_validator("mode", mode="before")
+    @classmethod
+    def _normalise_mode(cls, v):
+        return v.strip().lower() if isinstance(v, str) else v
+
+# Exactly one of image_data_url / image_url is set. image_url only appears for
+# a fresh generation requested with return_url_only; every cache hit carries
+# image_data_url, since cached images have no live Replicate URL.
 class GenerateResponse(BaseModel):
-    image_data_url: str
+    image_data_url: Optional[str] = Field(None, description="Image as a data URL; always set on cache hits.")
+    image_url: Optional[str] = Field(None, description="Replicate image URL; only for uncached return_url_only requests.")
     prompt: str
     cache_hit: bool
 
 # --------------------------------------------------
 # Helpers
 # --------------------------------------------------
-def throttle(request: Request):
-    ip = request.headers.get(
-        "x-forwarded-for",
-        request.client.host or "unknown"
-    ).split(",")[0].strip()
+# Same bucket as _take_token, kept in a Redis hash so every worker shares it.
+# Uses the Redis clock so workers' clocks never need to agree.
+_TOKEN_BUCKET_LUA = """
+local burst = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + (now - ts) / period)
+if tokens < 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
 
-    now = time.time()
-    last = _last_call_by_ip.get(ip, 0)
+def _take_token(ip: str) -> bool:
+    # No await between read and update, so the check is atomic per worker;
+    # the bucket is updated in place so each call hashes the IP once.
+    now = time.monotonic()
+    bucket = _last_call_by_ip.setdefault(ip, [RATE_LIMIT_BURST, now])
+    if len(_last_call_by_ip) > RATE_LIMIT_MAX_IPS:
+        # Hard cap between sweeps: drop the oldest-inserted IP, which at
+        # worst just hands it a fresh bucket
+        _last_call_by_ip.pop(next(iter(_last_call_by_ip)))
+    tokens = min(RATE_LIMIT_BURST, bucket[0] + (now - bucket[1]) / RATE_LIMIT_SECONDS)
+
+    if tokens < 1:
+        return False
+
+    bucket[0] = tokens - 1
+    bucket[1] = now
+    return True
+
+async def throttle(request: Request):
+    # Only the first hop is needed; partition stops at the first comma
+    xff = request.headers.get("x-forwarded-for")
+    if xff:
+        ip = xff.partition(",")[0].strip()
+    else:
+        ip = (request.client.host if request.client else None) or "unknown"
+
+    if request.app.state.redis is None:
+        allowed = _take_token(ip)
+    else:
+        try:
+            allowed = await request.app.state.take_token(
+                keys=[f"dme:rl:{ip}"],
+                args=[RATE_LIMIT_BURST, RATE_LIMIT_SECONDS, max(1, int(RATE_LIMIT_SECONDS * 10))],
+            )
+        except RedisError as e:
+            print(f"[throttle] Redis unavailable, limiting locally: {e}")
+            allowed = _take_token(ip)
 
-    if now - last < RATE_LIMIT_SECONDS:
+    if not allowed:
         raise HTTPException(
             status_code=429,
             detail="Hi there — I’m generating in the background. Wait ~3 seconds, then press Generate again."
         )
 
-    _last_call_by_ip[ip] = now
-
-def cache_key(payload: GenerateRequest) -> str:
-    raw = (
-        f"{REPLICATE_MODEL}|{DME_IMAGE_RES}|"
-        f"{payload.mood}|{payload.layout}|{payload.room or ''}|"
-        f"{payload.venue_image_url or ''}|"
-        f"{payload.av_equipment or ''}"
-        f"{payload.uplighting_colour or ''}"
+def cache_key(payload: GenerateRequest, model: str) -> CacheKey:
+    # The key only indexes the in-process dict, so a tuple of normalised
+    # fields is enough: CPython hashes it directly and it can't collide.
+    # Keyed on the resolved model so fast and quality results don't collide.
+    return (
+        model.lower(),
+        DME_IMAGE_RES.lower(),
+        payload.mood.lower(),
+        payload.layout.lower(),
+        (payload.room or "").lower(),
+        (payload.venue_image_url or "").lower(),
+        (payload.av_equipment or "").lower(),
+        (payload.uplighting_colour or "").lower(),
     )
-    return hashlib.sha256(raw.lower().encode("utf-8")).hexdigest()
 
-def get_cached(key: str) -> Optional[dict]:
-    item = _cache.get(key)
-    if not item:
+def _key_digest(key: CacheKey) -> str:
+    return hashlib.blake2b("\x1f".join(key).encode("utf-8"), digest_size=16).hexdigest()
+
+def _redis_key(key: CacheKey) -> str:
+    return f"dme:img:{_key_digest(key)}"
+
+def _read_blob(path: str) -> Optional[bytes]:
+    # Decompress straight from the mapping rather than reading a copy first
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return zlib.decompress(mm)
+    except FileNotFoundError:
         return None
 
-    created_ts, value = item
-    if time.time() - created_ts > CACHE_TTL_SECONDS:
+def _write_blob(path: str, blob: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, path)  # atomic, so readers never see a partial file
+    except OSError:
+        _remove_file(tmp)
+        raise
+
+# Rows are stamped with wall-clock time, since they outlive the process
+def _db_get(digest: str) -> Optional[Tuple[str, bytes, float]]:
+    with _db_lock:
+        row = _db.execute(
+            "SELECT mime, data, ts FROM cache WHERE key = ? AND ts >= ?",
+            (digest, time.time() - CACHE_TTL_SECONDS),
+        ).fetchone()
+    return row
+
+def _db_set(digest: str, mime: str, blob: bytes):
+    with _db_lock:
+        _db.execute(
+            "INSERT OR REPLACE INTO cache (key, ts, mime, data) VALUES (?, ?, ?, ?)",
+            (digest, time.time(), mime, blob),
+        )
+
+def _db_expire():
+    with _db_lock:
+        _db.execute("DELETE FROM cache WHERE ts < ?", (time.time() - CACHE_TTL_SECONDS,))
+
+async def _get_local(key: CacheKey) -> Optional[Tuple[str, bytes]]:
+    value = _cache.get(key)
+    if value is None:
+        return None
+
+    mime, blob, _ = value
+    if not CACHE_DIR:
+        return mime, zlib.decompress(blob)
+
+    try:
+        content = await asyncio.to_thread(_read_blob, blob)
+    except (zlib.error, ValueError) as e:  # ValueError: empty file, can't mmap
+        print(f"[cache] corrupt cache file {blob}: {e}")
+        _remove_file(blob)
+        content = None
+    except OSError as e:
+        print(f"[cache] disk read failed: {e}")
+        content = None
+    if content is None:
         _cache.pop(key, None)
         return None
+    return mime, content
+
+async def _set_local(key: CacheKey, mime: str, blob: bytes, ttl: float = CACHE_TTL_SECONDS):
+    expires = time.monotonic() + ttl
+    if not CACHE_DIR:
+        _cache[key] = (mime, blob, expires)
+        return
 
-    return value
+    path = os.path.join(CACHE_DIR, f"{_key_digest(key)}.{os.urandom(6).hex()}.bin")
+    try:
+        await asyncio.to_thread(_write_blob, path, blob)
+    except OSError as e:
+        # Same as the other tiers: the image just isn't cached locally
+        print(f"[cache] disk write failed: {e}")
+        return
+    _cache[key] = (mime, path, expires)
+
+async def _promote(key: CacheKey, mime: bytes | str, blob: bytes, ttl: float) -> Optional[Tuple[str, bytes]]:
+    # Validate an L2 entry before it reaches the in-process cache; a corrupt
+    # or foreign value is treated as a miss (and overwritten on regeneration)
+    try:
+        if isinstance(mime, bytes):
+            mime = mime.decode("ascii")
+        content = zlib.decompress(blob)
+    except (zlib.error, ValueError) as e:
+        print(f"[cache] discarding unreadable cache entry: {e}")
+        return None
 
-def set_cached(key: str, value: dict):
-    _cache[key] = (time.time(), value)
+    if ttl > 0:
+        await _set_local(key, mime, blob, ttl)
+    return mime, content
+
+async def get_cached(store: Optional[aioredis.Redis], key: CacheKey) -> Optional[Tuple[str, bytes]]:
+    """
+    Returns (mime, image bytes) for a cached generation.
+    In-process cache first, then SQLite (survives restarts), then Redis
+    (shared by all workers); hits are promoted into the in-process cache.
+    """
+    value = await _get_local(key)
+    if value is not None:
+        return value
+
+    if _db is not None:
+        try:
+            row = await asyncio.to_thread(_db_get, _key_digest(key))
+        except sqlite3.Error as e:
+            print(f"[cache] SQLite read failed: {e}")
+            row = None
+        if row is not None:
+            mime, blob, ts = row
+            value = await _promote(key, mime, blob, ts + CACHE_TTL_SECONDS - time.time())
+            if value is not None:
+                return value
+
+    if store is None:
+        return None
+
+    try:
+        raw, ttl = await store.pipeline(transaction=False).get(_redis_key(key)).ttl(_redis_key(key)).execute()
+    except RedisError as e:
+        print(f"[cache] Redis GET failed: {e}")
+        return None
+    if raw is None:
+        return None
+
+    mime, _, blob = raw.partition(b"\0")
+    # TTL is -1 only for keys set without an expiry
+    return await _promote(key, mime, blob, ttl if ttl >= 0 else CACHE_TTL_SECONDS)
+
+async def set_cached(store: Optional[aioredis.Redis], key: CacheKey, value: Tuple[str, bytes]):
+    # value is (mime, zlib-compressed image bytes)
+    mime, blob = value
+    await _set_local(key, mime, blob)
+    if _db is not None:
+        try:
+            await asyncio.to_thread(_db_set, _key_digest(key), mime, blob)
+        except sqlite3.Error as e:
+            print(f"[cache] SQLite write failed: {e}")
+    if store is None:
+        return
+
+    try:
+        await store.set(_redis_key(key), mime.encode("ascii") + b"\0" + blob, ex=CACHE_TTL_SECONDS)
+    except RedisError as e:
+        print(f"[cache] Redis SET failed: {e}")
+
+async def _sweep_expired():
+    # The cache only expires entries when touched, and the throttle map only
+    # ever inserts; sweep both so memory stays bounded. Expired SQLite rows
+    # and stale CACHE_DIR files are deleted here too.
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        _cache.expire()
+        if CACHE_DIR:
+            await asyncio.to_thread(_sweep_cache_dir)
+        if _db is not None:
+            try:
+                await asyncio.to_thread(_db_expire)
+            except sqlite3.Error as e:
+                print(f"[cache] SQLite cleanup failed: {e}")
+
+        # Idle this long, a bucket has refilled to RATE_LIMIT_BURST anyway
+        cutoff = time.monotonic() - RATE_LIMIT_SECONDS * 10
+        for ip in [ip for ip, (_, ts) in _last_call_by_ip.items() if ts < cutoff]:
+            _last_call_by_ip.pop(ip, None)
+
+@app.on_event("startup")
+async def _start_sweeper():
+    if CACHE_DIR:
+        await asyncio.to_thread(_sweep_cache_dir)
+    app.state.sweeper = asyncio.create_task(_sweep_expired())
+
+@app.on_event("shutdown")
+async def _stop_sweeper():
+    app.state.sweeper.cancel()
 
 # --------------------------------------------------
 # Designer negative prompt reference (ACTIVE for nano-banana)
@@ -166,36 +592,31 @@ No dramatic off centre framing
 # Negative prompt builder (NOT WIRED YET)
 # --------------------------------------------------
 
-def _np_split_lines(text: str) -> list[str]:
-    if not text:
-        return []
-    return [ln.strip() for ln in text.splitlines() if ln.strip()]
+def _np_split_lines(text: str) -> tuple[str, ...]:
+    return tuple(ln for ln in map(str.strip, text.splitlines()) if ln)
 
 
-def _np_dedupe_keep_order(items: list[str]) -> list[str]:
-    seen = set()
-    out = []
-    for it in items:
-        if it not in seen:
-            seen.add(it)
-            out.append(it)
-    return out
+# Split once at import; the builder only concatenates these
+_NP_GLOBAL_LINES = _np_split_lines(DESIGNER_NEGATIVE_PROMPTS.get("global", ""))
+_NP_LAYOUT_LINES = {
+    layout: _np_split_lines(text)
+    for layout, text in DESIGNER_NEGATIVE_PROMPTS.get("layout", {}).items()
+}
 
 
+@functools.lru_cache(maxsize=32)
 def build_designer_negative_prompt(*, layout: str | None = None) -> str:
     """
     Builds a single negative prompt string from DESIGNER_NEGATIVE_PROMPTS.
     Currently supports:
       - global
       - layout-specific (e.g. Theatre)
+    Cached per layout; the source text is static.
     """
-    parts: list[str] = []
-    parts += _np_split_lines(DESIGNER_NEGATIVE_PROMPTS.get("global", ""))
+    parts = _NP_GLOBAL_LINES + _NP_LAYOUT_LINES.get(layout, ())
 
-    if layout:
-        parts += _np_split_lines(DESIGNER_NEGATIVE_PROMPTS.get("layout", {}).get(layout, ""))
-
-    return "\n".join(_np_dedupe_keep_order(parts)).strip()
+    # dict.fromkeys dedupes while keeping first-seen order
+    return "\n".join(dict.fromkeys(parts))
 
 AV_EQUIPMENT_PROMPTS = {
 "IN": """
@@ -255,27 +676,26 @@ Ambient blue uplighting washes the walls evenly with a RGB colour (0,255,240). U
 # --------------------------------------------------
 # Prompt builder
 # --------------------------------------------------
-def build_prompt(mood: str, layout: str, room: Optional[str]) -> str:
-    venue_lock = (
-        "HIGHEST PRIORITY: Keep the exact architecture and the exact camera/view.\n"
-        "Do not change walls, ceiling height, columns, doors, windows, floor edges.\n"
-        "Do not change viewpoint, framing, horizon line, vanishing points, or lens/FOV.\n"
-    )
+_VENUE_LOCK = (
+    "HIGHEST PRIORITY: Keep the exact architecture and the exact camera/view.\n"
+    "Do not change walls, ceiling height, columns, doors, windows, floor edges.\n"
+    "Do not change viewpoint, framing, horizon line, vanishing points, or lens/FOV.\n"
+)
 
-    allowed_changes = (
-        "ALLOWED AND ENCOURAGED:\n"
-        "Apply strong event lighting, decor, furniture, florals, linens, and props.\n"
-        "Make the lighting and styling the dominant visual transformation.\n"
-        "The architecture and camera must remain unchanged.\n"
-    )
+_ALLOWED_CHANGES = (
+    "ALLOWED AND ENCOURAGED:\n"
+    "Apply strong event lighting, decor, furniture, florals, linens, and props.\n"
+    "Make the lighting and styling the dominant visual transformation.\n"
+    "The architecture and camera must remain unchanged.\n"
+)
 
-    composition = (
-        "Photorealistic event styling visualisation. High-end professional event photography. "
-        "Same camera position as the reference image. Realistic materials, realistic lighting, "
-        "no text, no logos, no watermark."
-    )
+_COMPOSITION = (
+    "Photorealistic event styling visualisation. High-end professional event photography. "
+    "Same camera position as the reference image. Realistic materials, realistic lighting, "
+    "no text, no logos, no watermark."
+)
 
-    unbreakable_rules = """
+_UNBREAKABLE_RULES = """
 UNBREAKABLE RULES
 SEATING_MODE = "THEATRE" | "BANQUET" | "LONG_TABLE" | "COCKTAIL"
 The seating mode variable controls all layout and styling behaviour. All conditional rules below are absolute and must not be violated.
@@ -365,57 +785,57 @@ Presenter, stage, LED wall, and AV configuration follow the AV PROMPT exactly. N
 """.strip()
 
 
-    mood_map = {
-        "Editorial": (
-            "EDITORIAL MOOD\n\n"
-            "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any fixed or structural elements.\n\n"
-            "Only update table linens, chair covers, and table centrepieces.\n\n"
-            "Style the event with a design-led, editorial aesthetic focused on intentional moments and strong visual composition. Every styling choice is deliberate, modern, and crafted to photograph beautifully.\n\n"
-            "Linens: Layered, high-quality fabrics with refined texture and structure — tailored tablecloths or runners in contemporary tones (soft neutrals, stone, charcoal, or muted colour accents). Crisp edges and controlled drape that enhance line and form.\n\n"
-            "Seat covers: Clean, architectural silhouettes in premium fabrics. Minimal, tailored, and sculptural — no bows, ties, or decorative excess. Colour and texture should support the overall composition, not compete with it.\n\n"
-            "Table centrepieces: Statement, sculptural floral installations designed as focal points. Florals feel modern and artistic rather than traditional, using intentional form, negative space, and controlled scale. Arrangements are visually striking but refined, never cluttered or oversized.\n\n"
-            "Table settings: Elevated and precise — refined tableware, layered glassware, and considered spacing that reinforces balance and symmetry.\n\n"
-            "Styling emphasises layered textures, contrast, and proportion, with a contemporary, gallery-like sensibility. The overall mood is confident, modern, and editorial, created for high-impact event photography.\n\n"
-            "Ultra-high resolution, photorealistic materials"
-        ),
-        "Luxe": (
-            "LUXE MOOD\n\n"
-            "Maintain the existing room architecture, lighting, layout, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any structural or spatial elements.\n\n"
-            "Only update table linens, chair covers, and table centrepieces.\n\n"
-            "Style the event with a luxury aesthetic that embodies refined glamour, opulence, and comfort. The atmosphere feels lavish yet liveable — sophisticated, inviting, and timeless rather than showy.\n\n"
-            "Linens: Tailored, high-quality fabrics with beautiful drape — silk-blend or premium textured linens in champagne, light metallic tones with warm undertones. Conveys elegance, subtle luxury, and a refined glow without overpowering the space.\n\n"
-            "Seat covers: Elegant and minimal, using soft upholstery, velvet, or refined fabric wraps in neutral or charcoal tones. Clean lines, subtle structure, no bows or decorative ties.\n\n"
-            "Table centrepieces: Sculptural. Elegant high floral arrangements with controlled form, subtle height variation, and restrained colour. Incorporate premium materials such as brushed brass vessels, smoked glass, or stone accents. No oversized, busy, or overly organic compositions.\n\n"
-            "Styling balances classic elegance with modern simplicity, with subtle Art Deco–inspired geometry (soft curves, symmetry, clean lines) expressed through proportions and finishes, not overt motifs.\n\n"
-            "Ultra-high resolution, photorealistic materials and lighting. No people, no branding, no text. The overall mood is confident, polished, and quietly indulgent, suitable for premium event marketing visuals."
-        ),
-        "Minimal": (
-            "MINIMAL MOOD\n\n"
-            "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not modify any fixed or structural elements.\n\n"
-            "Only update table linens, chair covers, and table centrepieces.\n\n"
-            "Style the event with a clean, contemporary aesthetic that prioritises simplicity, restraint, and calm. The overall mood is modern, architectural, and grounded.\n\n"
-            "Use a limited, cool-toned colour palette inspired by natural stone — muted greys, soft concrete, pale ash, and subtle charcoal accents only. Avoid warm tones or colour contrast.\n\n"
-            "Ultra-high resolution, photorealistic materials and lighting."
-        ),
-        "Mediterranean": (
-            "MEDITERRANEAN MOOD\n\n"
-            "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any fixed or structural elements.\n\n"
-            "Only update table linens, chair covers, and table centrepieces.\n\n"
-            "Style the event with a warm, relaxed, sun-washed aesthetic inspired by coastal Southern Europe. The mood feels grounded, social, and timeless — effortless rather than styled.\n\n"
-            "Use a warm, earthy colour palette inspired by natural clay, sunbaked landscapes, and subtle azure Mediterranean water tones. Colours should feel organic and softly weathered, never saturated or bold.\n\n"
-            "Ultra-high resolution, photorealistic materials and lighting."
-        ),
-        "Manhattan": (
-            "MANHATTAN MOOD\n\n"
-            "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any fixed or structural elements.\n\n"
-            "Only update table linens, chair covers, and table centrepieces.\n\n"
-            "Style the event with a Manhattan-inspired luxury aesthetic — bold, sleek, and urban, drawing from New York luxury hotel and penthouse interiors. The mood is confident, high-energy, and polished.\n\n"
-            "Use a dark, sophisticated colour palette: deep charcoal, black, rich espresso, and graphite, accented with controlled metallic highlights in brushed brass, champagne gold, or polished chrome.\n\n"
-            "Ultra-high resolution, photorealistic materials."
-        ),
-    }
+_MOOD_MAP = {
+    "Editorial": (
+        "EDITORIAL MOOD\n\n"
+        "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any fixed or structural elements.\n\n"
+        "Only update table linens, chair covers, and table centrepieces.\n\n"
+        "Style the event with a design-led, editorial aesthetic focused on intentional moments and strong visual composition. Every styling choice is deliberate, modern, and crafted to photograph beautifully.\n\n"
+        "Linens: Layered, high-quality fabrics with refined texture and structure — tailored tablecloths or runners in contemporary tones (soft neutrals, stone, charcoal, or muted colour accents). Crisp edges and controlled drape that enhance line and form.\n\n"
+        "Seat covers: Clean, architectural silhouettes in premium fabrics. Minimal, tailored, and sculptural — no bows, ties, or decorative excess. Colour and texture should support the overall composition, not compete with it.\n\n"
+        "Table centrepieces: Statement, sculptural floral installations designed as focal points. Florals feel modern and artistic rather than traditional, using intentional form, negative space, and controlled scale. Arrangements are visually striking but refined, never cluttered or oversized.\n\n"
+        "Table settings: Elevated and precise — refined tableware, layered glassware, and considered spacing that reinforces balance and symmetry.\n\n"
+        "Styling emphasises layered textures, contrast, and proportion, with a contemporary, gallery-like sensibility. The overall mood is confident, modern, and editorial, created for high-impact event photography.\n\n"
+        "Ultra-high resolution, photorealistic materials"
+    ),
+    "Luxe": (
+        "LUXE MOOD\n\n"
+        "Maintain the existing room architecture, lighting, layout, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any structural or spatial elements.\n\n"
+        "Only update table linens, chair covers, and table centrepieces.\n\n"
+        "Style the event with a luxury aesthetic that embodies refined glamour, opulence, and comfort. The atmosphere feels lavish yet liveable — sophisticated, inviting, and timeless rather than showy.\n\n"
+        "Linens: Tailored, high-quality fabrics with beautiful drape — silk-blend or premium textured linens in champagne, light metallic tones with warm undertones. Conveys elegance, subtle luxury, and a refined glow without overpowering the space.\n\n"
+        "Seat covers: Elegant and minimal, using soft upholstery, velvet, or refined fabric wraps in neutral or charcoal tones. Clean lines, subtle structure, no bows or decorative ties.\n\n"
+        "Table centrepieces: Sculptural. Elegant high floral arrangements with controlled form, subtle height variation, and restrained colour. Incorporate premium materials such as brushed brass vessels, smoked glass, or stone accents. No oversized, busy, or overly organic compositions.\n\n"
+        "Styling balances classic elegance with modern simplicity, with subtle Art Deco–inspired geometry (soft curves, symmetry, clean lines) expressed through proportions and finishes, not overt motifs.\n\n"
+        "Ultra-high resolution, photorealistic materials and lighting. No people, no branding, no text. The overall mood is confident, polished, and quietly indulgent, suitable for premium event marketing visuals."
+    ),
+    "Minimal": (
+        "MINIMAL MOOD\n\n"
+        "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not modify any fixed or structural elements.\n\n"
+        "Only update table linens, chair covers, and table centrepieces.\n\n"
+        "Style the event with a clean, contemporary aesthetic that prioritises simplicity, restraint, and calm. The overall mood is modern, architectural, and grounded.\n\n"
+        "Use a limited, cool-toned colour palette inspired by natural stone — muted greys, soft concrete, pale ash, and subtle charcoal accents only. Avoid warm tones or colour contrast.\n\n"
+        "Ultra-high resolution, photorealistic materials and lighting."
+    ),
+    "Mediterranean": (
+        "MEDITERRANEAN MOOD\n\n"
+        "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any fixed or structural elements.\n\n"
+        "Only update table linens, chair covers, and table centrepieces.\n\n"
+        "Style the event with a warm, relaxed, sun-washed aesthetic inspired by coastal Southern Europe. The mood feels grounded, social, and timeless — effortless rather than styled.\n\n"
+        "Use a warm, earthy colour palette inspired by natural clay, sunbaked landscapes, and subtle azure Mediterranean water tones. Colours should feel organic and softly weathered, never saturated or bold.\n\n"
+        "Ultra-high resolution, photorealistic materials and lighting."
+    ),
+    "Manhattan": (
+        "MANHATTAN MOOD\n\n"
+        "Maintain the existing room architecture, layout, lighting, walls, flooring, ceiling, staging, and AV exactly as shown. Do not alter any fixed or structural elements.\n\n"
+        "Only update table linens, chair covers, and table centrepieces.\n\n"
+        "Style the event with a Manhattan-inspired luxury aesthetic — bold, sleek, and urban, drawing from New York luxury hotel and penthouse interiors. The mood is confident, high-energy, and polished.\n\n"
+        "Use a dark, sophisticated colour palette: deep charcoal, black, rich espresso, and graphite, accented with controlled metallic highlights in brushed brass, champagne gold, or polished chrome.\n\n"
+        "Ultra-high resolution, photorealistic materials."
+    ),
+}
 
-    layout_map = {
+_LAYOUT_MAP = {
     "Cocktail": (
         'SEATING_MODE = "COCKTAIL"\n'
         "\n"
@@ -486,21 +906,114 @@ Presenter, stage, LED wall, and AV configuration follow the AV PROMPT exactly. N
         "Depth and density in theatre mode are created exclusively through rows, aisles, and human massing. Foreground is defined by the nearest seated rows and the central aisle. Midground is the densest concentration of seated attendees. Background resolves the stage and presenter clearly. Depth is reinforced by row repetition, central aisle perspective convergence, and subtle depth of field falloff. The image reads as layered, immersive, and three dimensional.\n"
     ),
 }
-   
- 
+
+def _join_prompt(mood_text: str, layout_text: str) -> str:
     return "\n".join([
-        venue_lock,
-        allowed_changes,
-        composition,
-        unbreakable_rules,
-        mood_map.get(mood, mood),
-        layout_map.get(layout, layout)
+        _VENUE_LOCK,
+        _ALLOWED_CHANGES,
+        _COMPOSITION,
+        _UNBREAKABLE_RULES,
+        mood_text,
+        layout_text,
     ])
 
+# Every known mood/layout pairing, joined once at import
+_PROMPTS = {
+    (mood, layout): _join_prompt(mood_text, layout_text)
+    for mood, mood_text in _MOOD_MAP.items()
+    for layout, layout_text in _LAYOUT_MAP.items()
+}
+
+def build_prompt(mood: str, layout: str, room: Optional[str]) -> str:
+    # mood/layout are validated against the map keys by GenerateRequest
+    return _PROMPTS[(mood, layout)]
+
+@functools.lru_cache(maxsize=256)
+def compose_prompt(
+    mood: str,
+    layout: str,
+    room: Optional[str],
+    av_equipment: Optional[str],
+    uplighting_colour: Optional[str],
+) -> str:
+    # Full prompt (scene + AV + uplighting); pure, so repeat requests are a lookup
+    prompt = build_prompt(mood, layout, room)
+
+    # av_equipment / uplighting_colour arrive normalised by GenerateRequest
+    if av_equipment == "IN":
+        prompt = prompt + "\n\n" + AV_EQUIPMENT_PROMPTS["IN"].strip()
+
+    upl_key = uplighting_colour or ""
+    if upl_key in UPLIGHTING_PROMPTS and UPLIGHTING_PROMPTS[upl_key].strip():
+        prompt = prompt + "\n\n" + UPLIGHTING_PROMPTS[upl_key].strip()
+
+    return prompt
+
 # --------------------------------------------------
 # Replicate integration (raw HTTP)
 # --------------------------------------------------
-def replicate_generate_image_url(
+# Config is fixed for the process lifetime, so request constants are built once
+_REPLICATE_HEADERS = {
+    "Authorization": f"Token {REPLICATE_API_TOKEN}",
+    "Content-Type": "application/json",
+}
+_REPLICATE_CREATE_HEADERS = (
+    {**_REPLICATE_HEADERS, "Prefer": f"wait={REPLICATE_PREFER_WAIT}"}
+    if REPLICATE_PREFER_WAIT > 0
+    else _REPLICATE_HEADERS
+)
+
+
+# Bounds generations in flight per worker
+_REPLICATE_SEM = asyncio.Semaphore(REPLICATE_CONCURRENCY)
+
+
+class ReplicateQueueTimeout(RuntimeError):
+    """No Replicate slot freed up within REPLICATE_QUEUE_SECONDS."""
+
+_NANO_BANANA_MODELS = frozenset({"google/nano-banana", "google/nano-banana-pro"})
+
+
+@functools.lru_cache(maxsize=None)
+def _create_url(model: str) -> str:
+    if "/" not in model:
+        raise RuntimeError("Resolved model must be 'owner/name'")
+
+    owner, name = model.split("/", 1)
+    return f"https://api.replicate.com/v1/models/{owner}/{name}/predictions"
+
+
+def _prediction_output(data: dict) -> Optional[str]:
+    # Output URL once succeeded, None while still running; raises on failure
+    status = data.get("status")
+    if status == "succeeded":
+        output = data.get("output")
+        if isinstance(output, list) and output:
+            return output[0]
+        if isinstance(output, str):
+            return output
+        raise RuntimeError("Unexpected Replicate output")
+
+    if status in ("failed", "canceled"):
+        raise RuntimeError(data.get("error", "Replicate failed"))
+
+    return None
+
+
+def _retry_after_seconds(r: httpx.Response) -> Optional[float]:
+    # Only the delta-seconds form; HTTP-date values are ignored
+    value = r.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+async def replicate_generate_image_url(
+    client: httpx.AsyncClient,
+    model: str,
     prompt: str,
     venue_image_url: Optional[str] = None,
     layout: Optional[str] = None,
@@ -509,19 +1022,7 @@ def replicate_generate_image_url(
     if not REPLICATE_API_TOKEN:
         raise RuntimeError("REPLICATE_API_TOKEN not configured")
 
-    mode = os.getenv("REPLICATE_MODE", "fast").strip().lower()
-    model = resolve_model(mode)
-
-    if "/" not in model:
-        raise RuntimeError("Resolved model must be 'owner/name'")
-
-    owner, name = model.split("/", 1)
-    create_url = f"https://api.replicate.com/v1/models/{owner}/{name}/predictions"
-
-    headers = {
-        "Authorization": f"Token {REPLICATE_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    create_url = _create_url(model)
 
     payload = {
         "input": {
@@ -529,8 +1030,10 @@ def replicate_generate_image_url(
         }
     }
 
+    is_nano_banana = model in _NANO_BANANA_MODELS
+
     # Only nano-banana models accept negative_prompt
-    if model in ("google/nano-banana", "google/nano-banana-pro"):
+    if is_nano_banana:
         negative_prompt = build_designer_negative_prompt(layout=layout)
         if negative_prompt:
             payload["input"]["negative_prompt"] = negative_prompt
@@ -541,7 +1044,7 @@ def replicate_generate_image_url(
 
     # Reference image handling
     if venue_image_url:
-        if model in ("google/nano-banana", "google/nano-banana-pro"):
+        if is_nano_banana:
             image_inputs = [venue_image_url]
             if av_reference_url:
                 image_inputs.append(av_reference_url)
@@ -550,44 +1053,137 @@ def replicate_generate_image_url(
             payload["input"]["image"] = venue_image_url
             payload["input"]["prompt_strength"] = 0.6
 
-    with httpx.Client(timeout=120.0) as client:
-        r = client.post(create_url, headers=headers, json=payload)
-        r.raise_for_status()
-        pred = r.json()
+    if PUBLIC_URL:
+        payload["webhook"] = f"{PUBLIC_URL}/api/webhook/replicate"
+        payload["webhook_events_filter"] = ["completed"]
 
-        poll_url = pred.get("urls", {}).get("get")
-        if not poll_url:
-            raise RuntimeError("Replicate response missing poll URL")
+    # Queue here rather than at Replicate: bursts beyond REPLICATE_CONCURRENCY
+    # wait their turn instead of coming back as upstream 429s. The wait is
+    # bounded so an overloaded worker sheds load rather than starting paid
+    # jobs for clients that have long given up.
+    try:
+        await asyncio.wait_for(_REPLICATE_SEM.acquire(), REPLICATE_QUEUE_SECONDS)
+    except asyncio.TimeoutError:
+        raise ReplicateQueueTimeout("Replicate queue is full") from None
+    try:
+        return await _run_prediction(client, create_url, payload)
+    finally:
+        _REPLICATE_SEM.release()
+
+
+def _should_retry_create(r: httpx.Response) -> bool:
+    # Creating a prediction isn't idempotent, so only retry responses that
+    # show nothing was created: 429 is rejected up front, and a 503 counts
+    # only if it carries no prediction. 500/502/504 may arrive after the
+    # prediction exists (e.g. while Prefer: wait holds the call open).
+    if r.status_code == 429:
+        return True
+    if r.status_code != 503:
+        return False
+    try:
+        data = orjson.loads(r.content)
+    except orjson.JSONDecodeError:
+        return True
+    return not (isinstance(data, dict) and "id" in data)
+
+
+async def _create_prediction(client: httpx.AsyncClient, create_url: str, payload: dict) -> dict:
+    body = orjson.dumps(payload)
+    for attempt in range(REPLICATE_MAX_RETRIES + 1):
+        r = await client.post(create_url, headers=_REPLICATE_CREATE_HEADERS, content=body)
+        if attempt == REPLICATE_MAX_RETRIES or not _should_retry_create(r):
+            break
+        retry_after = _retry_after_seconds(r)
+        await asyncio.sleep(min(10.0, retry_after if retry_after is not None else 0.5 * 2 ** attempt))
+
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+async def _run_prediction(client: httpx.AsyncClient, create_url: str, payload: dict) -> str:
+    deadline = time.monotonic() + REPLICATE_TIMEOUT_SECONDS
+    pred = await _create_prediction(client, create_url, payload)
+
+    # With Prefer: wait, the create call usually returns the finished prediction
+    output = _prediction_output(pred)
+    if output is not None:
+        return output
+
+    poll_url = pred.get("urls", {}).get("get")
+    if not poll_url:
+        raise RuntimeError("Replicate response missing poll URL")
+
+    # The webhook only wakes us early; the prediction is always re-read from
+    # Replicate, and a webhook lost (or delivered to another worker) just
+    # falls back to the slow poll.
+    pred_id = pred.get("id")
+    wake = None
+    if PUBLIC_URL and pred_id:
+        wake = _pending[pred_id] = asyncio.Event()
 
-        for _ in range(240):
-            g = client.get(poll_url, headers=headers)
+    try:
+        # Poll quickly at first so fast jobs return promptly, then back off
+        delay = 0.15
+        retry_after = None
+        while time.monotonic() < deadline:
+            if wake is not None:
+                try:
+                    await asyncio.wait_for(
+                        wake.wait(),
+                        min(WEBHOOK_FALLBACK_SECONDS, max(0.0, deadline - time.monotonic())),
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+            else:
+                # Replicate's own Retry-After hint wins over our backoff
+                wait = retry_after if retry_after is not None else delay
+                await asyncio.sleep(min(wait, max(0.0, deadline - time.monotonic())))
+                delay = min(2.0, delay * 1.5)
+
+            g = await client.get(poll_url, headers=_REPLICATE_HEADERS)
             g.raise_for_status()
-            data = g.json()
+            output = _prediction_output(orjson.loads(g.content))
+            if output is not None:
+                return output
+            retry_after = _retry_after_seconds(g)
+    finally:
+        if wake is not None:
+            _pending.pop(pred_id, None)
 
-            status = data.get("status")
-            if status == "succeeded":
-                output = data.get("output")
-                if isinstance(output, list) and output:
-                    return output[0]
-                if isinstance(output, str):
-                    return output
-                raise RuntimeError("Unexpected Replicate output")
+    raise RuntimeError("Replicate request timed out")
 
-            if status in ("failed", "canceled"):
-                raise RuntimeError(data.get("error", "Replicate failed"))
 
-            time.sleep(0.75)
+# Multiple of 3, so each chunk base64-encodes without mid-stream padding
+_DOWNLOAD_CHUNK = 57 * 1024
 
-    raise RuntimeError("Replicate request timed out")
 
-
-def download_image_as_data_url(url: str) -> str:
-    with httpx.Client(timeout=120.0, follow_redirects=True) as client:
-        r = client.get(url)
+async def download_image(client: httpx.AsyncClient, url: str) -> Tuple[str, bytes, str]:
+    """
+    Streams the image once, returning (mime, zlib-compressed bytes, data URL).
+    Chunks are base64-encoded straight into the data URL and compressed for
+    the cache, so the raw image is never held in memory as a whole.
+    """
+    z = zlib.compressobj(1)
+    blob = bytearray()
+    async with client.stream("GET", url) as r:
         r.raise_for_status()
         mime = r.headers.get("content-type", "image/png")
-        b64 = base64.b64encode(r.content).decode("utf-8")
-        return f"data:{mime};base64,{b64}"
+        data_url = bytearray(_data_url_prefix(mime))
+        async for chunk in r.aiter_bytes(_DOWNLOAD_CHUNK):
+            data_url += base64.b64encode(chunk)
+            blob += z.compress(chunk)
+    blob += z.flush()
+    return mime, bytes(blob), data_url.decode("ascii")
+
+
+def _data_url_prefix(mime: str) -> bytes:
+    return b"data:" + mime.encode("ascii") + b";base64,"
+
+
+def to_data_url(mime: str, content: bytes) -> str:
+    # Assemble in bytes and decode once; base64 output is pure ASCII
+    return (_data_url_prefix(mime) + base64.b64encode(content)).decode("ascii")
 
 # --------------------------------------------------
 # Routes
@@ -596,48 +1192,122 @@ def download_image_as_data_url(url: str) -> str:
 def health():
     return {"ok": True}
 
+@app.post("/api/webhook/replicate")
+async def replicate_webhook(request: Request):
+    try:
+        event = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid webhook body")
+
+    wake = _pending.get(event.get("id")) if isinstance(event, dict) else None
+    if wake is not None:
+        wake.set()
+    return {"ok": True}
+
 @app.post("/api/generate", response_model=GenerateResponse)
-def generate(req: GenerateRequest, request: Request):
-    throttle(request)
+async def generate(req: GenerateRequest, request: Request):
+    await throttle(request)
 
-    key = cache_key(req)
-    cached = get_cached(key)
+    model = resolve_model(req.mode or REPLICATE_MODE)
+    key = cache_key(req, model)
+    store = request.app.state.redis
+    cached = await get_cached(store, key)
     if cached:
-        return GenerateResponse(**cached, cache_hit=True)
-
-    prompt = build_prompt(req.mood, req.layout, req.room)
-    
-    if (req.av_equipment or "").strip().upper() == "IN":
-        prompt = prompt + "\n\n" + AV_EQUIPMENT_PROMPTS["IN"].strip()
-        
-    upl_key = (req.uplighting_colour or "").strip().lower()
-    if upl_key in UPLIGHTING_PROMPTS and UPLIGHTING_PROMPTS[upl_key].strip():
-        prompt = prompt + "\n\n" + UPLIGHTING_PROMPTS[upl_key].strip()
+        mime, content = cached
+        # Serialise directly: re-validating a multi-MB data URL through
+        # GenerateResponse buys nothing for data we produced ourselves.
+        return ORJSONResponse({
+            # Also for return_url_only: a cached image has no Replicate URL
+            "image_data_url": to_data_url(mime, content),
+            "image_url": None,
+            "prompt": compose_prompt(
+                req.mood,
+                req.layout,
+                req.room,
+                req.av_equipment,
+                req.uplighting_colour,
+            ),
+            "cache_hit": True,
+        })
+
+    # Identical requests arriving while this one is generating share its job
+    # (URL-only results are a different response, so they fly separately)
+    flight_key = key + ("url-only",) if req.return_url_only else key
+    pending = _inflight.get(flight_key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[flight_key] = fut
+    try:
+        resp = await _generate_uncached(req, request.app.state.http, store, model, key)
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved in case nobody was waiting
+        raise
+    else:
+        fut.set_result(resp)
+    finally:
+        _inflight.pop(flight_key, None)
+        if not fut.done():
+            fut.cancel()
+
+    return resp
+
+
+async def _generate_uncached(
+    req: GenerateRequest,
+    client: httpx.AsyncClient,
+    store: Optional[aioredis.Redis],
+    model: str,
+    key: CacheKey,
+) -> GenerateResponse:
+    prompt = compose_prompt(
+        req.mood,
+        req.layout,
+        req.room,
+        req.av_equipment,
+        req.uplighting_colour,
+    )
 
     # If AV is IN, use a second reference image: av-in (bridge)
     av_reference_url = None
-    if (req.av_equipment or "").strip().upper() == "IN" and req.venue_image_url:
+    if req.av_equipment == "IN" and req.venue_image_url:
         base, last = req.venue_image_url.rsplit("/", 1)
         ext = "." + last.split(".")[-1] if "." in last else ".JPG"
         av_reference_url = f"{base}/av-in.jpg"
 
 
     try:
-        image_url = replicate_generate_image_url(
+        image_url = await replicate_generate_image_url(
+            client,
+            model,
             prompt,
             req.venue_image_url,
             req.layout,
             av_reference_url,
         )
-        data_url = download_image_as_data_url(image_url)
-
-        resp = {
-            "image_data_url": data_url,
-            "prompt": prompt,
-        }
+        if req.return_url_only:
+            # Replicate delivery URLs expire, so there is nothing to cache
+            return GenerateResponse(image_url=image_url, prompt=prompt, cache_hit=False)
+
+        mime, blob, data_url = await download_image(client, image_url)
+
+        # Cache only the compressed image; the data URL is rebuilt on a hit
+        # and the prompt is recomputed by the memoised compose_prompt.
+        await set_cached(store, key, (mime, blob))
+        return GenerateResponse(
+            image_data_url=data_url,
+            prompt=prompt,
+            cache_hit=False,
+        )
 
-        set_cached(key, resp)
-        return GenerateResponse(**resp, cache_hit=False)
+    except ReplicateQueueTimeout:
+        raise HTTPException(
+            status_code=503,
+            detail="Lots of designs are generating right now. Wait ~10 seconds, then press Generate again.",
+            headers={"Retry-After": "10"},
+        )
 
     except httpx.HTTPStatusError as e:
         status = None